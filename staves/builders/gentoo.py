@@ -4,17 +4,24 @@ import logging
 import multiprocessing
 import os
 import shutil
+import stat
 import struct
 import subprocess
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
 
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import (
+    AbstractSet,
+    Dict,
     Mapping,
     NewType,
     Optional,
     Sequence,
+    Set,
 )
 
 
@@ -24,6 +31,15 @@ logger = logging.getLogger(__name__)
 Environment = NewType("Environment", Mapping[str, str])
 
 
+_made_dirs: Set[str] = set()
+
+
+def _ensure_dir(path: str):
+    if path not in _made_dirs:
+        os.makedirs(path, exist_ok=True)
+        _made_dirs.add(path)
+
+
 class Libc(Enum):
     glibc = auto()
     musl = auto()
@@ -33,6 +49,7 @@ class Libc(Enum):
 class BuilderConfig:
     libc: Libc
     concurrent_jobs: int = None
+    max_cpu_load: int = None
 
 
 class StavesError(Exception):
@@ -52,7 +69,11 @@ class PackagingConfig:
 
 
 def _create_rootfs(
-    rootfs_path, *packages, max_concurrent_jobs: int = 1, max_cpu_load: int = 1
+    rootfs_path,
+    *packages,
+    max_concurrent_jobs: int = 1,
+    max_make_jobs: int = 1,
+    max_cpu_load: int = 1,
 ):
     logger.info(
         "Creating rootfs at {} containing the following packages:".format(rootfs_path)
@@ -60,8 +81,10 @@ def _create_rootfs(
     logger.info(", ".join(packages))
 
     logger.debug("Installing build-time dependencies to builder")
-    emerge_env = os.environ
-    emerge_env["MAKEOPTS"] = "-j{} -l{}".format(max_concurrent_jobs, max_cpu_load)
+    emerge_env = {
+        **os.environ,
+        "MAKEOPTS": "-j{} -l{}".format(max_make_jobs, max_cpu_load),
+    }
     # --emptytree is needed, because build dependencies of runtime dependencies are ignored by --root-deps=rdeps
     # (even when --with-bdeps=y is passed). By adding --emptytree, we get a binary package that can be installed to rootfs
     emerge_bdeps_command = [
@@ -77,11 +100,7 @@ def _create_rootfs(
         str(max_cpu_load),
         *packages,
     ]
-    emerge_bdeps_call = subprocess.run(
-        emerge_bdeps_command, stderr=subprocess.PIPE, env=emerge_env
-    )
-    if emerge_bdeps_call.returncode != 0:
-        logger.error(emerge_bdeps_call.stderr)
+    if _run_and_log_stderr(emerge_bdeps_command, env=emerge_env) != 0:
         raise RootfsError("Unable to install build-time dependencies.")
 
     logger.debug("Installing runtime dependencies to rootfs")
@@ -98,11 +117,7 @@ def _create_rootfs(
         str(max_cpu_load),
         *packages,
     ]
-    emerge_rdeps_call = subprocess.run(
-        emerge_rdeps_command, stderr=subprocess.PIPE, env=emerge_env
-    )
-    if emerge_rdeps_call.returncode != 0:
-        logger.error(emerge_rdeps_call.stderr)
+    if _run_and_log_stderr(emerge_rdeps_command, env=emerge_env) != 0:
         raise RootfsError("Unable to install runtime dependencies.")
 
 
@@ -110,44 +125,149 @@ def _max_cpu_load() -> int:
     return multiprocessing.cpu_count()
 
 
-def _max_concurrent_jobs() -> int:
-    return _max_cpu_load() + 1
+# Memory needed by a single compiler job of a typical package
+_MEMORY_PER_JOB = 2 * 1024 ** 3
+_MEMINFO_PATH = "/proc/meminfo"
+
+
+def _available_memory() -> Optional[int]:
+    try:
+        with open(_MEMINFO_PATH) as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _memory_job_budget() -> Optional[int]:
+    """Returns the number of compiler jobs that fit into the available memory.
+
+    Returns None if the available memory cannot be determined.
+    """
+    available_memory = _available_memory()
+    if available_memory is None:
+        return None
+    return max(1, available_memory // _MEMORY_PER_JOB)
+
+
+def _max_make_jobs(memory_job_budget: Optional[int]) -> int:
+    make_jobs = _max_cpu_load() + 1
+    if memory_job_budget is not None:
+        make_jobs = min(make_jobs, memory_job_budget)
+    return make_jobs
+
+
+def _max_concurrent_jobs(make_jobs: int, memory_job_budget: Optional[int]) -> int:
+    # Each emerge job runs make with make_jobs jobs, so the number of emerge jobs
+    # is only lowered when their product would exceed the memory budget
+    concurrent_jobs = _max_cpu_load() + 1
+    if (
+        memory_job_budget is not None
+        and concurrent_jobs * make_jobs > memory_job_budget
+    ):
+        concurrent_jobs = max(1, memory_job_budget // make_jobs)
+    return concurrent_jobs
+
+
+def _copy_file(src: str, dst: str) -> str:
+    """Copies src to dst inside the kernel, falling back to shutil.copy2.
+
+    os.copy_file_range avoids moving the data through userspace and creates
+    a reflink on filesystems that support it.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as source, open(dst, "wb") as target:
+                size = os.fstat(source.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    chunk_size = os.copy_file_range(
+                        source.fileno(), target.fileno(), size - copied
+                    )
+                    if chunk_size == 0:
+                        break
+                    copied += chunk_size
+            # Some filesystems report success without copying anything
+            if copied == size:
+                shutil.copystat(src, dst)
+                return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def _copy_tree(src: str, dst: str):
+    """Copies the directory tree src to dst, merging into dst if it exists.
+
+    GNU cp copies large trees considerably faster than shutil.copytree and
+    uses reflinks where the filesystem supports them.
+    """
+    # Without --no-target-directory, cp copies into dst/<basename> when dst
+    # exists
+    run_and_log_error(
+        ["cp", "--archive", "--reflink=auto", "--no-target-directory", src, dst]
+    )
+
+
+_GCC_LIBRARY_PATH = os.path.join("/usr", "lib", "gcc")
+
+
+def _find_gcc_libs(search_path: str, names: AbstractSet[str]) -> Dict[str, str]:
+    """Returns the paths of the files with the specified names below search_path.
+
+    The search stops as soon as a file was found for every name.
+    """
+    found = {}
+    directories = [search_path]
+    while directories and len(found) < len(names):
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            # Missing or unreadable directories are skipped, like os.walk does
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name in names and entry.name not in found:
+                    found[entry.name] = entry.path
+    return found
 
 
 def _copy_stdlib(rootfs_path: str, copy_libstdcpp: bool):
     libgcc = "libgcc_s.so.1"
     libstdcpp = "libstdc++.so.6"
-    search_path = os.path.join("/usr", "lib", "gcc")
-    libgcc_path = None
-    libstdcpp_path = None
-    for directory_path, subdirs, files in os.walk(search_path):
-        if libgcc in files:
-            libgcc_path = os.path.join(directory_path, libgcc)
-        if libstdcpp in files:
-            libstdcpp_path = os.path.join(directory_path, libstdcpp)
-    if libgcc_path is None:
-        raise StavesError("Unable to find " + libgcc + " in " + search_path)
-    shutil.copy(libgcc_path, os.path.join(rootfs_path, "usr", "lib"))
-    if copy_libstdcpp:
-        if libstdcpp_path is None:
-            raise StavesError("Unable to find " + libstdcpp + " in " + search_path)
-        shutil.copy(libstdcpp_path, os.path.join(rootfs_path, "usr", "lib"))
+    search_path = _GCC_LIBRARY_PATH
+    libs = {libgcc, libstdcpp} if copy_libstdcpp else {libgcc}
+    lib_paths = _find_gcc_libs(search_path, libs)
+    missing_libs = libs - lib_paths.keys()
+    if missing_libs:
+        raise StavesError(
+            "Unable to find " + ", ".join(sorted(missing_libs)) + " in " + search_path
+        )
+    for lib_path in lib_paths.values():
+        _copy_file(lib_path, os.path.join(rootfs_path, "usr", "lib"))
 
 
 def _copy_to_rootfs(rootfs: str, path_glob: str):
     globs = glob.iglob(path_glob)
     for host_path in globs:
         rootfs_path = os.path.join(rootfs, os.path.relpath(host_path, "/"))
-        os.makedirs(os.path.dirname(rootfs_path), exist_ok=True)
-        if os.path.islink(
-            host_path
-        ):  # Needs to be checked first, because other methods follow links
+        _ensure_dir(os.path.dirname(rootfs_path))
+        # lstat does not follow links, so a single call tells links apart from
+        # the files and directories they point to
+        mode = os.lstat(host_path).st_mode
+        if stat.S_ISLNK(mode):
             link_target = os.readlink(host_path)
             os.symlink(link_target, rootfs_path)
-        elif os.path.isdir(host_path):
-            shutil.copytree(host_path, rootfs_path)
-        elif os.path.isfile(host_path):
-            shutil.copy(host_path, rootfs_path)
+        elif stat.S_ISDIR(mode):
+            _copy_tree(host_path, rootfs_path)
+        elif stat.S_ISREG(mode):
+            _copy_file(host_path, rootfs_path)
         else:
             raise StavesError(
                 "Copying {} to rootfs is not supported.".format(path_glob)
@@ -167,23 +287,52 @@ class Repository:
     sync_type: str
 
 
+def _run_and_log_stderr(cmd: Sequence[str], **kwargs) -> int:
+    """Runs cmd and logs its error output if it fails.
+
+    The error output is spooled to a temporary file instead of a pipe, because
+    it is only read when the command fails.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        returncode = subprocess.run(cmd, stderr=stderr, **kwargs).returncode
+        if returncode != 0:
+            stderr.seek(0)
+            logger.error(stderr.read().decode(errors="replace"))
+    return returncode
+
+
 def run_and_log_error(cmd: Sequence[str]) -> int:
-    cmd = subprocess.run(
-        cmd, universal_newlines=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
-    )
-    if cmd.returncode != 0:
-        logger.error(cmd.stderr)
+    returncode = _run_and_log_stderr(cmd, stdout=subprocess.DEVNULL)
+    if returncode != 0:
         raise StavesError(f"Command failed: {cmd}")
-    return cmd.returncode
+    return returncode
+
+
+# Upper bound for concurrent repository syncs to avoid overloading the remotes
+_MAX_CONCURRENT_SYNCS = 8
+
+
+_PACKAGE_CONFIG_DIRS = {
+    "env": "package.env",
+    "keywords": "package.accept_keywords",
+    "use": "package.use",
+}
 
 
 class BuildEnvironment:
-    def __init__(self):
-        os.makedirs("/etc/portage/repos.conf", exist_ok=True)
+    def __init__(self, portage_config_path: str = os.path.join("/etc", "portage")):
+        self.portage_config_path = portage_config_path
+        _ensure_dir(os.path.join(self.portage_config_path, "repos.conf"))
 
     def add_repository(self, repository: Repository):
+        self.write_repository_config(repository)
+        self.update_repository(repository.name)
+
+    def write_repository_config(self, repository: Repository):
         logger.info(f"Adding repository {repository.name}")
-        repository_config_path = Path("/etc/portage/repos.conf") / repository.name
+        repository_config_path = (
+            Path(self.portage_config_path) / "repos.conf" / repository.name
+        )
         repository_config = f"""\
         [{repository.name}]
         location = /var/db/repos/{repository.name}
@@ -191,49 +340,60 @@ class BuildEnvironment:
         sync-uri = {repository.uri}
         """
         repository_config_path.write_text(repository_config)
-        self.update_repository(repository.name)
+
+    def add_repositories(self, repositories: Sequence[Repository]):
+        if not repositories:
+            return
+        # emaint reads all of repos.conf, so every configuration is written
+        # before the first sync starts
+        for repository in repositories:
+            self.write_repository_config(repository)
+        # Syncing is mostly waiting for the network, so the repositories are
+        # synced concurrently
+        max_workers = min(_MAX_CONCURRENT_SYNCS, len(repositories))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(
+                executor.map(
+                    self.update_repository,
+                    [repository.name for repository in repositories],
+                )
+            )
 
     def update_repository(self, name: str):
         run_and_log_error(["emaint", "sync", "--repo", name])
 
-    def write_package_config(
-        self,
-        package: str,
-        env: Sequence[str] = None,
-        keywords: Sequence[str] = None,
-        use: Sequence[str] = None,
-    ):
-        if env:
-            package_config_path = os.path.join(
-                "/etc", "portage", "package.env", *package.split("/")
+    def write_package_configs(self, package_configs: Mapping[str, Mapping]):
+        # Portage reads every file in a package.* directory, so the settings of
+        # all packages in a category are written to a single file
+        category_configs = defaultdict(list)
+        for package, package_config in package_configs.items():
+            unknown_settings = package_config.keys() - _PACKAGE_CONFIG_DIRS.keys()
+            if unknown_settings:
+                raise StavesError(
+                    "Unsupported settings for {}: {}".format(
+                        package, ", ".join(sorted(unknown_settings))
+                    )
+                )
+            category = package.split("/")[0]
+            for setting, values in package_config.items():
+                if values:
+                    category_configs[(setting, category)].append(
+                        "{} {}".format(package, " ".join(values))
+                    )
+        for (setting, category), lines in category_configs.items():
+            config_dir = os.path.join(
+                self.portage_config_path, _PACKAGE_CONFIG_DIRS[setting]
             )
-            os.makedirs(os.path.dirname(package_config_path), exist_ok=True)
-            with open(package_config_path, "w") as f:
-                package_environments = " ".join(env)
-                f.write("{} {}{}".format(package, package_environments, os.linesep))
-        if keywords:
-            package_config_path = os.path.join(
-                "/etc", "portage", "package.accept_keywords", *package.split("/")
-            )
-            os.makedirs(os.path.dirname(package_config_path), exist_ok=True)
-            with open(package_config_path, "w") as f:
-                package_keywords = " ".join(keywords)
-                f.write("{} {}{}".format(package, package_keywords, os.linesep))
-        if use:
-            package_config_path = os.path.join(
-                "/etc", "portage", "package.use", *package.split("/")
-            )
-            os.makedirs(os.path.dirname(package_config_path), exist_ok=True)
-            with open(package_config_path, "w") as f:
-                package_use_flags = " ".join(use)
-                f.write("{} {}{}".format(package, package_use_flags, os.linesep))
+            _ensure_dir(config_dir)
+            with open(os.path.join(config_dir, category), "w") as f:
+                f.write(os.linesep.join(lines) + os.linesep)
 
     def write_env(self, env_vars, name=None):
-        os.makedirs("/etc/portage/env", exist_ok=True)
+        _ensure_dir(os.path.join(self.portage_config_path, "env"))
         if name:
-            conf_path = os.path.join("/etc", "portage", "env", name)
+            conf_path = os.path.join(self.portage_config_path, "env", name)
         else:
-            conf_path = os.path.join("/etc", "portage", "make.conf")
+            conf_path = os.path.join(self.portage_config_path, "make.conf")
         with open(conf_path, "a") as make_conf:
             make_conf.writelines(
                 ('{}="{}"{}'.format(k, v, os.linesep) for k, v in env_vars.items())
@@ -272,18 +432,21 @@ def build(
         for env_name, env in image_spec.package_envs.items():
             build_env.write_env(name=env_name, env_vars=env)
     if image_spec.repositories:
-        for repository in image_spec.repositories:
-            build_env.add_repository(repository)
-    for package, package_config in image_spec.package_configs.items():
-        build_env.write_package_config(package, **package_config)
+        build_env.add_repositories(image_spec.repositories)
+    build_env.write_package_configs(image_spec.package_configs)
     packages = list(image_spec.packages_to_be_installed)
     packages.append("virtual/libc")
-    concurrent_jobs = config.concurrent_jobs or _max_concurrent_jobs()
+    memory_job_budget = _memory_job_budget()
+    make_jobs = _max_make_jobs(memory_job_budget)
+    concurrent_jobs = config.concurrent_jobs or _max_concurrent_jobs(
+        make_jobs, memory_job_budget
+    )
     _create_rootfs(
         rootfs_path,
         *packages,
         max_concurrent_jobs=concurrent_jobs,
-        max_cpu_load=_max_cpu_load(),
+        max_make_jobs=make_jobs,
+        max_cpu_load=config.max_cpu_load or _max_cpu_load(),
     )
     _copy_stdlib(rootfs_path, copy_libstdcpp=stdlib)
     if config.libc == Libc.glibc:
@@ -327,13 +490,26 @@ if __name__ == "__main__":
         help="Do not copy stdlib into target image",
     )
     parser.set_defaults(stdlib=False)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Maximum number of packages built concurrently",
+    )
+    parser.add_argument(
+        "--load",
+        type=int,
+        help="Do not start new build jobs above this load average",
+    )
     args = parser.parse_args()
 
     content_length = struct.unpack(">Q", sys.stdin.buffer.read(8))[0]
-    print(f"Reading {content_length} bytes…")
+    sys.stdout.write(f"Reading {content_length} bytes…{os.linesep}")
     content = sys.stdin.buffer.read(content_length)
-    print(f"Deserializing content")
+    sys.stdout.write(f"Deserializing content{os.linesep}")
     image_spec = _deserialize_image_spec(content)
+    # Subprocesses write to the same file descriptor, so pending output has to
+    # be flushed before any of them starts
+    sys.stdout.flush()
     portageq_call = subprocess.run(
         ["portageq", "envvar", "ELIBC"], stdout=subprocess.PIPE, check=True
     )
@@ -346,7 +522,9 @@ if __name__ == "__main__":
         raise StavesError(f"Unsupported ELIBC: {elibc}")
     build(
         image_spec,
-        config=BuilderConfig(libc=libc),
+        config=BuilderConfig(
+            libc=libc, concurrent_jobs=args.jobs, max_cpu_load=args.load
+        ),
         stdlib=args.stdlib,
     )
     vdb_metadata_cache_path = Path("/tmp/rootfs") / "var" / "db" / "pkg"
@@ -1,6 +1,7 @@
 """Installs Gentoo portage packages into a specified directory."""
 
 import io
+import json
 import logging
 import os
 import tarfile
@@ -85,6 +86,18 @@ def cli(log_level: str):
     show_default=True,
     help="Version number of the packaged artifact",
 )
+@click.option(
+    "--jobs",
+    type=int,
+    help="Maximum number of packages built concurrently "
+    "[default: derived from the number of CPUs and the available memory]",
+)
+@click.option(
+    "--load",
+    type=int,
+    help="Do not start new build jobs above this load average "
+    "[default: number of CPUs]",
+)
 def build(
     config,
     stdlib,
@@ -96,6 +109,8 @@ def build(
     locale,
     image_path,
     version,
+    jobs,
+    load,
 ):
     image_spec = _read_image_spec(config)
     image_path = Path(image_path)
@@ -110,6 +125,8 @@ def build(
             ssh=ssh,
             netrc=netrc,
             env={"LANG": locale},
+            jobs=jobs,
+            load=load,
         )
     else:
         click.echo(
@@ -174,19 +191,14 @@ def _read_packaging_config(config_file: IO) -> PackagingConfig:
 
 
 def _create_dockerfile(annotations: Mapping[str, str], *cmd: str) -> str:
-    label_string = " ".join(
-        [f'"{key}"="{value}"' for key, value in annotations.items()]
-    )
-    command_string = ", ".join(['"{}"'.format(c) for c in cmd])
-    dockerfile = ""
-    if label_string:
-        dockerfile += "LABEL {label_string}" + os.linesep
-    dockerfile += f"""\
-    FROM scratch
-    COPY rootfs /
-    ENTRYPOINT [{command_string}]
-    """
-    return dockerfile
+    lines = ["FROM scratch"]
+    if annotations:
+        label_string = " ".join(
+            [f'"{key}"="{value}"' for key, value in annotations.items()]
+        )
+        lines.append(f"LABEL {label_string}")
+    lines += ["COPY rootfs /", f"ENTRYPOINT {json.dumps(list(cmd))}"]
+    return "\n".join(lines) + "\n"
 
 
 def _docker_image_from_rootfs(
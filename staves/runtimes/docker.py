@@ -4,6 +4,7 @@ import logging
 import os
 import socket
 import struct
+import sys
 import tarfile
 from dataclasses import asdict
 from pathlib import Path
@@ -29,6 +30,8 @@ def run(
     ssh: bool = False,
     netrc: bool = False,
     env: Mapping[str, str] = None,
+    jobs: int = None,
+    load: int = None,
 ):
     docker_client = docker.from_env()
 
@@ -66,8 +69,11 @@ def run(
     logger.debug("Starting docker container with the following mounts:")
     for mount in mounts:
         logger.debug(str(mount))
-    for log_output in docker_client.api.pull(portage, stream=True, decode=True):
-        print(log_output)
+    sys.stdout.writelines(
+        f"{log_output}{os.linesep}"
+        for log_output in docker_client.api.pull(portage, stream=True, decode=True)
+    )
+    sys.stdout.flush()
     portage_container = docker_client.containers.create(
         portage,
         auto_remove=True,
@@ -75,6 +81,10 @@ def run(
     args = []
     if stdlib:
         args += ["--stdlib"]
+    if jobs:
+        args += ["--jobs", str(jobs)]
+    if load:
+        args += ["--load", str(load)]
     container = docker_client.containers.create(
         builder,
         entrypoint=["/usr/bin/python", "/staves.py"],
@@ -109,8 +119,13 @@ def run(
     container_input._sock.send(content)
     container_input._sock.shutdown(socket.SHUT_RDWR)
     container_input.close()
-    for line in container.logs(stream=True):
-        print(line.decode(), end="")
+    # Frames are passed through as bytes. Decoding them individually is
+    # wasted work and fails when a frame ends inside a multi-byte character
+    sys.stdout.flush()
+    output = sys.stdout.buffer
+    for frame in container.logs(stream=True):
+        output.write(frame)
+        output.flush()
     container.stop()
     container.wait()
     image_chunks, _ = container.get_archive("/tmp/rootfs")
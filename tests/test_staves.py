@@ -1,8 +1,16 @@
 import os
 
+import pytest
 import toml
 from click.testing import CliRunner
-from staves.cli import cli
+import staves.builders.gentoo as gentoo
+from staves.builders.gentoo import (
+    BuildEnvironment,
+    Repository,
+    StavesError,
+    _copy_tree,
+)
+from staves.cli import cli, _create_dockerfile
 
 
 def test_creates_lib_symlink(tmpdir, monkeypatch, mocker):
@@ -65,3 +73,164 @@ def test_copies_libgcc(tmpdir, monkeypatch, mocker):
 
     assert result.exit_code == 0, result.output
     assert os.path.exists(os.path.join(rootfs_path, "usr", "lib64", "libgcc_s.so.1"))
+
+
+def test_dockerfile_contains_labels_and_entrypoint():
+    dockerfile = _create_dockerfile(
+        {"maintainer": "staves"}, "/bin/bash", "-c", 'echo "hi"'
+    )
+
+    assert dockerfile.splitlines() == [
+        "FROM scratch",
+        'LABEL "maintainer"="staves"',
+        "COPY rootfs /",
+        'ENTRYPOINT ["/bin/bash", "-c", "echo \\"hi\\""]',
+    ]
+
+
+def test_copy_tree_does_not_nest_into_existing_destination(tmpdir):
+    source = tmpdir.mkdir("source")
+    source.mkdir("sub").join("deep").write("")
+    destination = tmpdir.mkdir("destination")
+
+    _copy_tree(str(source), str(destination))
+
+    assert destination.join("sub", "deep").check(file=True)
+    assert not destination.join("source").check()
+
+
+def test_writes_package_configs_per_category(tmpdir):
+    build_env = BuildEnvironment(portage_config_path=str(tmpdir))
+
+    build_env.write_package_configs(
+        {
+            "app-shells/bash": {"use": ["-nls"], "keywords": ["~amd64"]},
+            "app-shells/zsh": {"use": ["pcre", "-doc"]},
+        }
+    )
+
+    assert tmpdir.join("package.use", "app-shells").read().splitlines() == [
+        "app-shells/bash -nls",
+        "app-shells/zsh pcre -doc",
+    ]
+    assert tmpdir.join("package.accept_keywords", "app-shells").read().splitlines() == [
+        "app-shells/bash ~amd64",
+    ]
+    assert not tmpdir.join("package.env").check()
+
+
+def test_rejects_unknown_package_config_settings(tmpdir):
+    build_env = BuildEnvironment(portage_config_path=str(tmpdir))
+
+    with pytest.raises(StavesError, match="usee"):
+        build_env.write_package_configs({"app-shells/bash": {"usee": ["-nls"]}})
+
+
+@pytest.mark.parametrize(
+    "cpu_count, available_gib, expected_concurrent_jobs, expected_make_jobs",
+    [
+        (64, 16 * 1024, 65, 65),
+        (64, 256, 1, 65),
+        (4, 64, 5, 5),
+        (32, 64, 1, 32),
+        (32, 3, 1, 1),
+    ],
+)
+def test_compiler_jobs_fit_into_available_memory(
+    tmpdir,
+    monkeypatch,
+    mocker,
+    cpu_count,
+    available_gib,
+    expected_concurrent_jobs,
+    expected_make_jobs,
+):
+    available_kib = available_gib * 1024 ** 2
+    meminfo = tmpdir.join("meminfo")
+    meminfo.write(
+        "MemTotal:       {} kB\nMemAvailable:   {} kB\n".format(
+            2 * available_kib, available_kib
+        )
+    )
+    monkeypatch.setattr(gentoo, "_MEMINFO_PATH", str(meminfo))
+    mocker.patch(
+        "staves.builders.gentoo.multiprocessing.cpu_count", return_value=cpu_count
+    )
+
+    memory_job_budget = gentoo._memory_job_budget()
+    make_jobs = gentoo._max_make_jobs(memory_job_budget)
+    concurrent_jobs = gentoo._max_concurrent_jobs(make_jobs, memory_job_budget)
+
+    assert make_jobs == expected_make_jobs
+    assert concurrent_jobs == expected_concurrent_jobs
+
+
+def test_compiler_jobs_without_meminfo(tmpdir, monkeypatch, mocker):
+    monkeypatch.setattr(gentoo, "_MEMINFO_PATH", str(tmpdir.join("missing")))
+    mocker.patch("staves.builders.gentoo.multiprocessing.cpu_count", return_value=8)
+
+    memory_job_budget = gentoo._memory_job_budget()
+    make_jobs = gentoo._max_make_jobs(memory_job_budget)
+
+    assert memory_job_budget is None
+    assert make_jobs == 9
+    assert gentoo._max_concurrent_jobs(make_jobs, memory_job_budget) == 9
+
+
+def test_syncs_repositories_after_all_configs_are_written(tmpdir, mocker):
+    build_env = BuildEnvironment(portage_config_path=str(tmpdir))
+    repositories = [
+        Repository(name, f"https://example.com/{name}.git", "git")
+        for name in ("first", "second", "third")
+    ]
+    configs_at_sync = []
+
+    def update_repository(name):
+        configs_at_sync.append(
+            sorted(path.basename for path in tmpdir.join("repos.conf").listdir())
+        )
+
+    mocker.patch.object(build_env, "update_repository", side_effect=update_repository)
+
+    build_env.add_repositories(repositories)
+
+    assert configs_at_sync == [["first", "second", "third"]] * 3
+
+
+def test_copy_stdlib_reports_missing_gcc_library_tree(tmpdir, monkeypatch):
+    missing_path = str(tmpdir.join("missing"))
+    monkeypatch.setattr(gentoo, "_GCC_LIBRARY_PATH", missing_path)
+
+    with pytest.raises(StavesError, match="libgcc_s.so.1"):
+        gentoo._copy_stdlib(str(tmpdir.mkdir("rootfs")), copy_libstdcpp=False)
+
+
+
+def test_copy_file_falls_back_when_copy_file_range_copies_nothing(tmpdir, mocker):
+    source = tmpdir.join("libgcc_s.so.1")
+    source.write_binary(b"\x7fELF" * 1024)
+    destination = tmpdir.mkdir("lib")
+    mocker.patch("os.copy_file_range", return_value=0, create=True)
+
+    gentoo._copy_file(str(source), str(destination))
+
+    assert destination.join("libgcc_s.so.1").read_binary() == source.read_binary()
+
+
+def test_adding_no_repositories_does_nothing(tmpdir, mocker):
+    build_env = BuildEnvironment(portage_config_path=str(tmpdir))
+    update_repository = mocker.patch.object(build_env, "update_repository")
+
+    build_env.add_repositories([])
+
+    update_repository.assert_not_called()
+
+
+def test_add_repository_writes_config_and_syncs(tmpdir, mocker):
+    build_env = BuildEnvironment(portage_config_path=str(tmpdir))
+    update_repository = mocker.patch.object(build_env, "update_repository")
+
+    build_env.add_repository(Repository("first", "https://example.com/first", "git"))
+
+    assert tmpdir.join("repos.conf", "first").check(file=True)
+    update_repository.assert_called_once_with("first")